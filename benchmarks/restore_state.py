@@ -0,0 +1,51 @@
+"""
+Times VGDLEnv.restore_state after short random rollouts, the way a planner
+uses it, on every sample game with grid observations. Reports the best median
+of a few runs, and fails when restoring pacman (the sample level with the
+most sprites) takes a millisecond or more.
+
+    python benchmarks/restore_state.py
+"""
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+import numpy as np
+from gym_vgdl.register_samples import sample_games, classes, resources, DATA_DIR
+from gym_vgdl.vgdl_env import VGDLEnv
+
+
+def time_restore(game, runs=5, rollouts=100, depth=5):
+    env = VGDLEnv(game_file=os.path.join(DATA_DIR, game + '.txt'),
+                  level_file=os.path.join(DATA_DIR, game + '_lvl0.txt'),
+                  obs_type='grid', notable_sprites=classes[game],
+                  notable_resources=resources[game])
+    rng = random.Random(0)
+    env.reset()
+    for _ in range(20):
+        env.step(rng.randrange(env.action_space.n))
+    state = env.clone_state()
+    medians = []
+    for _ in range(runs):
+        times = []
+        for _ in range(rollouts):
+            for _ in range(depth):
+                if env.step(rng.randrange(env.action_space.n))[2]:
+                    break
+            start = time.perf_counter()
+            env.restore_state(state)
+            times.append(time.perf_counter() - start)
+        medians.append(np.median(times))
+    env.close()
+    return min(medians) * 1e3
+
+
+if __name__ == '__main__':
+    results = {}
+    for game in sample_games:
+        results[game] = time_restore(game)
+        print('%-15s %.3f ms' % (game, results[game]))
+    if results['pacman'] >= 1.0:
+        sys.exit('restore_state on pacman takes %.3f ms' % results['pacman'])
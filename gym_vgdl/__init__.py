@@ -1,17 +1,29 @@
 from gym.envs.registration import register
-from gym_vgdl.vgdl_env import VGDLEnv
 from .register_samples import register_sample_games
-import os
 
 # Register samples
 register_sample_games()
 
 register(
     id='vgdl_generic-v0',
-    entry_point='gym_vgdl:VGDLEnv',
+    entry_point='gym_vgdl.vgdl_env:VGDLEnv',
     kwargs={
         'block_size': 10
     },
     nondeterministic=True,
 )
 
+
+# The envs pull in pygame and the game engine, so they are only
+# imported once they are actually used
+_lazy_attributes = {
+    'VGDLEnv': 'gym_vgdl.vgdl_env',
+    'VGDLVecEnv': 'gym_vgdl.vgdl_vec_env',
+    'SubprocVGDLVecEnv': 'gym_vgdl.vgdl_vec_env',
+}
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        import importlib
+        return getattr(importlib.import_module(_lazy_attributes[name]), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,32 @@
+import numpy as np
+
+
+class FrameRingBuffer(object):
+    """ Keeps the last k frames in a preallocated circular buffer.
+
+    Every frame is written twice, k slots apart, so the last k frames
+    (oldest first) are always one contiguous slice of the buffer and can
+    be handed out without stacking them.
+    """
+
+    def __init__(self, k, shape, dtype):
+        self.k = k
+        self._buf = np.zeros((2 * k,) + tuple(shape), dtype=dtype)
+        self._pos = 0
+
+    def clear(self):
+        self._buf.fill(0)
+
+    def push(self, frame):
+        self._pos = (self._pos + 1) % self.k
+        self._buf[self._pos] = frame
+        self._buf[self._pos + self.k] = frame
+
+    def view(self):
+        """ Read-only (k,) + shape view of the stack, valid until the next push. """
+        stacked = self._buf[self._pos + 1:self._pos + 1 + self.k]
+        stacked.flags.writeable = False
+        return stacked
+
+    def copy(self):
+        return self._buf[self._pos + 1:self._pos + 1 + self.k].copy()
@@ -0,0 +1,147 @@
+import json
+import os
+import numpy as np
+
+
+class TrajectoryRecorder(object):
+    """ Streams transitions into chunks of preallocated, memory-mapped .npy files.
+
+    Every chunk holds chunk_size rows of observations, actions, rewards and
+    done flags, one file per array (dict observations get one file per key).
+    Row t is the observation an action was taken in, that action, and the
+    reward and done flag it led to. firsts flags the first row of every
+    episode, and timeouts the last row of an episode that was cut short
+    without being done: by a reset before the game ended (a time limit,
+    say), or by closing the recorder. index.json lists how many rows of every
+    chunk are valid; it is rewritten on every flush, so a recording that was
+    cut short can still be read. Only one chunk is mapped at a time (and
+    the flags of the one before, until the next reset), which keeps memory flat however long the recording gets.
+
+    Recording starts with the first observation of a reset: observations and
+    steps before that, of an episode already under way, are left out.
+    """
+
+    def __init__(self, directory, obs_spec, chunk_size=10000, flush_every=1000):
+        assert chunk_size >= 1 and flush_every >= 1
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.flush_every = flush_every
+        # (name, shape of a row, dtype) of every array
+        self._spec = [('observations' if key is None else 'observations-' + key, shape, dtype)
+                      for key, (shape, dtype) in obs_spec.items()]
+        self._spec += [('actions', (), np.int64),
+                       ('rewards', (), np.float32),
+                       ('dones', (), np.bool_),
+                       ('firsts', (), np.bool_),
+                       ('timeouts', (), np.bool_)]
+        self._obs_names = [name for name, _, _ in self._spec[:len(obs_spec)]]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lengths = []
+        self._arrays = None
+        self._row = 0
+        self._started = False
+        self._observed = False
+        # dones and timeouts of the last row, which may be in the previous chunk
+        self._last = None
+        self._unflushed = 0
+
+    def _path(self, name, chunk):
+        return os.path.join(self.directory, '%s_%05d.npy' % (name, chunk))
+
+    def _open_chunk(self):
+        self._close_chunk()
+        chunk = len(self._lengths)
+        self._arrays = {name: np.lib.format.open_memmap(self._path(name, chunk), mode='w+',
+                                                        dtype=dtype, shape=(self.chunk_size,) + shape)
+                        for name, shape, dtype in self._spec}
+        self._lengths.append(0)
+        self._row = 0
+
+    def _close_chunk(self):
+        if self._arrays is None:
+            return
+        n = self._lengths[-1]
+        for name, array in self._arrays.items():
+            array.flush()
+            if n < self.chunk_size:
+                # cut the preallocated rows that were never written
+                path = self._path(name, len(self._lengths) - 1)
+                np.save(path + '.tmp.npy', array[:n])
+                os.replace(path + '.tmp.npy', path)
+        self._arrays = None
+        self._write_index()
+
+    def _write_index(self):
+        path = os.path.join(self.directory, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'chunks': self._lengths}, f)
+        os.replace(path + '.tmp', path)
+
+    def observe(self, obs, reset=False):
+        """ The observation the next action is taken in, the first of an
+        episode if reset. """
+        self._started = self._started or reset
+        if not self._started:
+            return
+        if reset:
+            self._truncate()
+        if self._arrays is None or self._row == self.chunk_size:
+            self._open_chunk()
+        self._arrays['firsts'][self._row] = reset
+        if len(self._obs_names) == 1:
+            self._arrays[self._obs_names[0]][self._row] = obs
+        else:
+            for name in self._obs_names:
+                self._arrays[name][self._row] = obs[name[len('observations-'):]]
+        self._observed = True
+
+    def _truncate(self):
+        # the last row ends its episode, done or not
+        if self._last is None:
+            return
+        dones, timeouts, row = self._last
+        timeouts[row] = not dones[row]
+        if timeouts is not self._arrays['timeouts']:
+            timeouts.flush()
+        self._last = None
+
+    def step(self, action, reward, done):
+        """ The action taken in the last observation, and its outcome. """
+        if not self._observed:
+            # before the first reset
+            return
+        arrays, row = self._arrays, self._row
+        arrays['actions'][row] = action
+        arrays['rewards'][row] = reward
+        arrays['dones'][row] = done
+        self._last = arrays['dones'], arrays['timeouts'], row
+        self._row += 1
+        self._lengths[-1] = self._row
+        self._observed = False
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._arrays is not None:
+            for array in self._arrays.values():
+                array.flush()
+        self._write_index()
+        self._unflushed = 0
+
+    def close(self):
+        self._truncate()
+        self._close_chunk()
+
+
+def load_recording(directory, mmap_mode='r'):
+    """ The arrays of a recording, by name, as lists of (memory-mapped) chunks. """
+    with open(os.path.join(directory, 'index.json')) as f:
+        lengths = json.load(f)['chunks']
+    names = sorted(set(name.rsplit('_', 1)[0] for name in os.listdir(directory)
+                       if name.endswith('.npy') and not name.endswith('.tmp.npy')))
+    return {name: [np.load(os.path.join(directory, '%s_%05d.npy' % (name, chunk)),
+                           mmap_mode=mmap_mode)[:n]
+                   for chunk, n in enumerate(lengths)]
+            for name in names}
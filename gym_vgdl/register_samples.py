@@ -1,5 +1,4 @@
 from gym.envs.registration import register
-from gym_vgdl.vgdl_env import VGDLEnv
 import os
 
 # Location of sample games
@@ -51,16 +50,16 @@ suffixes = {
     'image':    "",
     'objects':  "_objects",
     'features': "_features",
+    'grid':     "_grid",
 }
 
-# Register the sample games
+# Register the sample games, the envs themselves are only imported by gym.make
 def register_sample_games():
-    print("Yo")
     for game in sample_games:
         for obs_type, suffix in suffixes.items():
             register(
                 id='vgdl_{}{}-v0'.format(game, suffix),
-                entry_point='gym_vgdl:VGDLEnv',
+                entry_point='gym_vgdl.vgdl_env:VGDLEnv',
                 kwargs={
                     'game_file': os.path.join( DATA_DIR, game + '.txt'),
                     'level_file': os.path.join( DATA_DIR, game + '_lvl0.txt'),
@@ -72,4 +71,3 @@ def register_sample_games():
                 timestep_limit=1000,
                 nondeterministic=True,
             )
-            print("Registering vgdl_{}{}-v0".format(game, suffix))
@@ -0,0 +1,244 @@
+'''
+Video game description language -- compact binary encoding of game states.
+
+A state (see BasicGame.get_state) is stored as the differences of every
+sprite to a freshly built sprite of its type, which is all that changes
+while playing: positions, orientations, speeds, colors, counters and
+resources. Everything else is filled in again from the game definition
+when decoding, so an encoded state can only be decoded by the same game.
+'''
+
+import struct
+import pygame
+
+
+MAGIC = b'VGDL'
+VERSION = 1
+
+# attributes that are encoded separately, or never differ from the sprite type
+_SKIPPED = frozenset(['rect', 'lastrect', 'resources', 'physics', 'image', 'scale_image',
+                      '_hashrect', '_hashcells', '_serial', '_gridcell'])
+
+_header = struct.Struct('<4sH')
+_u8 = struct.Struct('<B')
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+_i64 = struct.Struct('<q')
+_f64 = struct.Struct('<d')
+_rect = struct.Struct('<iiii')
+_counts = struct.Struct('<BB')
+_game = struct.Struct('<qBi')
+_killed = struct.Struct('<HI')
+_mt = struct.Struct('<625I')
+
+
+class _Writer(object):
+    def __init__(self):
+        self.parts = []
+        self.strings = {}
+
+    def string(self, s):
+        """ Index of s in the string table. """
+        i = self.strings.get(s)
+        if i is None:
+            i = self.strings[s] = len(self.strings)
+        return i
+
+    def value(self, v):
+        parts = self.parts
+        if v is None:
+            parts.append(b'n')
+        elif v is True or v is False:
+            parts.append(b'b' + _u8.pack(v))
+        elif type(v) is int:
+            parts.append(b'i' + _i64.pack(v))
+        elif type(v) is float:
+            parts.append(b'f' + _f64.pack(v))
+        elif type(v) is str:
+            parts.append(b's' + _u16.pack(self.string(v)))
+        elif type(v) in (tuple, list):
+            parts.append((b't' if type(v) is tuple else b'l') + _u8.pack(len(v)))
+            for x in v:
+                self.value(x)
+        else:
+            raise ValueError("Can not encode a value of type %s" % type(v).__name__)
+
+
+class _Reader(object):
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+        self.strings = []
+
+    def take(self, size):
+        """ Position of the next size bytes, which have to be there. """
+        pos = self.pos
+        if pos + size > len(self.data):
+            raise ValueError("Corrupt game state: truncated at byte %d" % pos)
+        self.pos += size
+        return pos
+
+    def unpack(self, st):
+        return st.unpack_from(self.data, self.take(st.size))
+
+    def string(self, i):
+        if i >= len(self.strings):
+            raise ValueError("Corrupt game state: no string %d" % i)
+        return self.strings[i]
+
+    def value(self):
+        pos = self.take(1)
+        tag = self.data[pos:pos + 1]
+        if tag == b'n':
+            return None
+        elif tag == b'b':
+            return bool(self.unpack(_u8)[0])
+        elif tag == b'i':
+            return self.unpack(_i64)[0]
+        elif tag == b'f':
+            return self.unpack(_f64)[0]
+        elif tag == b's':
+            return self.string(self.unpack(_u16)[0])
+        elif tag in (b't', b'l'):
+            n, = self.unpack(_u8)
+            items = [self.value() for _ in range(n)]
+            return tuple(items) if tag == b't' else items
+        raise ValueError("Corrupt game state: unknown value tag %r" % tag)
+
+
+def encodeState(game, state):
+    """ The state of game (from get_state) as bytes. """
+    w = _Writer()
+    parts = w.parts
+    string, value = w.string, w.value
+
+    parts.append(_u16.pack(len(state['groups'])))
+    for key, copies in state['groups']:
+        template = game._spriteTemplate(key).__dict__
+        parts.append(_u16.pack(string(key)) + _u32.pack(len(copies)))
+        for _, d in copies:
+            rect = d['rect']
+            parts.append(_rect.pack(rect.x, rect.y, rect.w, rect.h))
+            lastrect = d['lastrect']
+            if lastrect is rect:
+                parts.append(b'\x00')
+            else:
+                parts.append(b'\x01' + _rect.pack(lastrect.x, lastrect.y, lastrect.w, lastrect.h))
+            changed = [(k, v) for k, v in d.items() if k not in _SKIPPED
+                       and not (k in template and type(template[k]) is type(v) and template[k] == v)]
+            resources = d['resources'] or {}
+            assert len(changed) < 256 and len(resources) < 256
+            parts.append(_counts.pack(len(changed), len(resources)))
+            for k, v in changed:
+                parts.append(_u16.pack(string(k)))
+                try:
+                    value(v)
+                except ValueError:
+                    raise ValueError("Can not encode attribute '%s' of sprite '%s'" % (k, key))
+            for k, v in resources.items():
+                parts.append(_u16.pack(string(k)))
+                value(v)
+
+    parts.append(_u32.pack(len(state['killed'])))
+    for key, i in state['killed']:
+        parts.append(_killed.pack(string(key), i))
+
+    parts.append(_game.pack(state['time'], state['ended'], state['num_sprites']))
+    value(state['score'])
+    version, mt, gauss = state['random']
+    parts.append(_u8.pack(version) + _mt.pack(*mt))
+    value(gauss)
+
+    # the string table goes first, so that the values can be looked up while decoding
+    strings = [_u16.pack(len(w.strings))]
+    for s in w.strings:
+        b = s.encode('utf-8')
+        strings.append(_u16.pack(len(b)) + b)
+    return b''.join([_header.pack(MAGIC, VERSION)] + strings + parts)
+
+
+def decodeState(game, data):
+    """ The state encoded by encodeState, ready for set_state.
+    Raises ValueError for anything that is not such a state of game. """
+    data = bytes(data)
+    if len(data) < _header.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not an encoded game state")
+    magic, version = _header.unpack_from(data, 0)
+    if version != VERSION:
+        raise ValueError("Unsupported game state version %d" % version)
+    r = _Reader(data, _header.size)
+    unpack, value, string = r.unpack, r.value, r.string
+
+    n, = unpack(_u16)
+    for _ in range(n):
+        size, = unpack(_u16)
+        pos = r.take(size)
+        # UnicodeDecodeError is a ValueError too
+        r.strings.append(data[pos:pos + size].decode('utf-8'))
+
+    def readRect():
+        x, y, w, h = unpack(_rect)
+        if not (0 <= w <= width and 0 <= h <= height):
+            raise ValueError("Corrupt game state: sprite of size %dx%d" % (w, h))
+        return pygame.Rect(x, y, w, h)
+
+    groups = []
+    width, height = game.screensize
+    # sprites are numbered again, their order is all that counts
+    serial = 0
+    n, = unpack(_u16)
+    for _ in range(n):
+        key_id, = unpack(_u16)
+        count, = unpack(_u32)
+        key = string(key_id)
+        if key not in game.sprite_constr:
+            raise ValueError("Corrupt game state: unknown sprite type '%s'" % key)
+        template = game._spriteTemplate(key)
+        sclass, attrs = template.__class__, template.__dict__
+        copies = []
+        for _ in range(count):
+            d = attrs.copy()
+            d['rect'] = rect = readRect()
+            d['lastrect'] = readRect() if unpack(_u8)[0] else rect
+            nattrs, nres = unpack(_counts)
+            for _ in range(nattrs):
+                k = string(unpack(_u16)[0])
+                d[k] = value()
+            resources = {}
+            for _ in range(nres):
+                k = string(unpack(_u16)[0])
+                resources[k] = value()
+            d['resources'] = resources or None
+            d['_hashcells'] = game._hashCells(rect)
+            d['_serial'] = serial
+            serial += 1
+            copies.append((sclass, d))
+        groups.append((key, copies))
+
+    n, = unpack(_u32)
+    killed = []
+    counts = dict((key, len(copies)) for key, copies in groups)
+    for _ in range(n):
+        key_id, i = unpack(_killed)
+        key = string(key_id)
+        if i >= counts.get(key, 0):
+            raise ValueError("Corrupt game state: no killed sprite %s %d" % (key, i))
+        killed.append((key, i))
+
+    time, ended, num_sprites = unpack(_game)
+    score = value()
+    version, = unpack(_u8)
+    mt = unpack(_mt)
+    gauss = value()
+    if r.pos != len(data):
+        raise ValueError("Corrupt game state: %d bytes too many" % (len(data) - r.pos))
+    return {'groups': groups,
+            'killed': killed,
+            'score': score,
+            'time': time,
+            'ended': bool(ended),
+            'num_sprites': num_sprites,
+            'next_serial': serial,
+            'grid': None,
+            'random': (version, mt, gauss),
+            }
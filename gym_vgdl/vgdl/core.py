@@ -6,26 +6,109 @@ Video game description language -- parser, framework and core game classes.
 
 import pygame
 import random
+import copy
+import numpy as np
 from .tools import Node, indentTreeParser
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from .tools import roundedPoints
+from .codec import encodeState, decodeState
 import math
+import numbers
 import os
 import sys
+import hashlib
+import json
+import ast
+import types
+import functools
 
 VGDL_GLOBAL_IMG_LIB = {}
 
+@functools.lru_cache(maxsize=4096)
+def _literal(estr):
+    """ Python literal written in estr, or estr itself if it is not one. """
+    try:
+        return ast.literal_eval(estr)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return estr
+
 class VGDLParser(object):
     """ Parses a string into a Game object. """
     verbose = False
 
+    # Parsed game descriptions are kept in memory (the cache_size most
+    # recently used ones), and written to cache_dir as JSON if that is set.
+    # Bump cache_version whenever parsing changes, so old entries are not used.
+    cache_size = 64
+    cache_dir = os.environ.get('VGDL_CACHE_DIR')
+    cache_version = 2
+    _cache = OrderedDict()
+    # names usable in descriptions, see _symbolTable
+    _symbols = None
+
     def parseGame(self, tree, **kwargs):
         """ Accepts either a string, or a tree. """
-        if not isinstance(tree, Node):
-            tree = indentTreeParser(tree).children[0]
+        if isinstance(tree, Node):
+            spec = self._parseSpec(tree)
+        else:
+            spec = self._gameSpec(tree)
+        self.game = self._buildGame(spec, kwargs)
+        return self.game
+
+    def _gameSpec(self, gstr):
+        """ Everything parsed from a game description, looked up in the caches first. """
+        key = hashlib.sha1(('%d\n' % self.cache_version + gstr).encode('utf-8')).hexdigest()
+        cache = VGDLParser._cache
+        if key in cache:
+            cache[key] = cache.pop(key)
+            return cache[key]
+
+        spec = None
+        path = self.cache_dir and os.path.join(self.cache_dir, 'vgdl-%s.json' % key)
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                if data['version'] == self.cache_version:
+                    spec = self._fromJson(data['spec'])
+            except Exception:
+                spec = None
+        if spec is None:
+            spec = self._parseSpec(indentTreeParser(gstr).children[0])
+            if path:
+                # write to a temporary file first, other processes may be reading
+                tmp = '%s.%d' % (path, os.getpid())
+                try:
+                    data = {'version': self.cache_version, 'spec': self._toJson(spec)}
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    with open(tmp, 'w') as f:
+                        json.dump(data, f)
+                    os.replace(tmp, path)
+                except Exception:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+
+        cache[key] = spec
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return spec
+
+    def _parseSpec(self, tree):
+        """ 
+        What the game tree defines, on top of what every game has (see
+        _buildGame). Nothing is built yet, the spec only holds literals
+        and ontology symbols.
+        """
         sclass, args = self._parseArgs(tree.content)
-        args.update(kwargs)
-        self.game = sclass(**args)
+        self._spec = {'class': sclass,
+                      'args': args,
+                      'sprite_constr': {},
+                      'sprite_order': [],
+                      'singletons': [],
+                      'collision_eff': [],
+                      'char_mapping': {},
+                      'terminations': [],
+                      }
         for c in tree.children:
             if c.content == "SpriteSet":
                 self.parseSprites(c.children)
@@ -36,16 +119,93 @@ class VGDLParser(object):
             if c.content == "TerminationSet":
                 self.parseTerminations(c.children)
         
-        return self.game
+        return self._spec
+
+    def _buildGame(self, spec, kwargs):
+        """ A new game from a parsed description, with fresh copies of everything mutable. """
+        args = dict(spec['args'])
+        args.update(kwargs)
+        game = spec['class'](**args)
+        game.sprite_constr.update(spec['sprite_constr'])
+        for key in spec['sprite_order']:
+            if key in game.sprite_order:
+                # last one counts
+                game.sprite_order.remove(key)
+            game.sprite_order.append(key)
+        game.singletons.extend(spec['singletons'])
+        game.collision_eff.extend(spec['collision_eff'])
+        game.char_mapping.update(spec['char_mapping'])
+        for sclass, targs in spec['terminations']:
+            game.terminations.append(sclass(**targs))
+        return game
+
+    def _toJson(self, value):
+        """ value of a spec in a form JSON can hold, with ontology symbols by name. """
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, (type, types.FunctionType)):
+            if self._symbolTable().get(value.__name__) is not value:
+                raise ValueError("Not an ontology symbol: %r" % value)
+            return {'symbol': value.__name__}
+        if isinstance(value, list):
+            return [self._toJson(v) for v in value]
+        if isinstance(value, tuple):
+            return {'tuple': [self._toJson(v) for v in value]}
+        if isinstance(value, (set, frozenset)):
+            return {'set': [self._toJson(v) for v in value]}
+        if isinstance(value, dict):
+            return {'dict': [[self._toJson(k), self._toJson(v)] for k, v in value.items()]}
+        raise ValueError("Can not cache a value of type %s" % type(value).__name__)
+
+    def _fromJson(self, value):
+        """ Inverse of _toJson, symbols are only ever looked up in the symbol table. """
+        if isinstance(value, list):
+            return [self._fromJson(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        (kind, v), = value.items()
+        if kind == 'symbol':
+            return self._symbolTable()[v]
+        if kind == 'tuple':
+            return tuple(self._fromJson(x) for x in v)
+        if kind == 'set':
+            return set(self._fromJson(x) for x in v)
+        if kind == 'dict':
+            return dict((self._fromJson(k), self._fromJson(x)) for k, x in v)
+        raise ValueError("Unknown cached value %r" % kind)
+
+    def _symbolTable(self):
+        """ 
+        The classes and functions of core and the ontology, and the
+        color and direction constants, by name.
+        """
+        if VGDLParser._symbols is None:
+            from . import ontology
+            modules = (__name__, ontology.__name__)
+            symbols = {}
+            for name, value in list(globals().items()) + list(vars(ontology).items()):
+                if name.startswith('_'):
+                    continue
+                if isinstance(value, (type, types.FunctionType)) and value.__module__ in modules:
+                    symbols[name] = value
+                elif isinstance(value, tuple):
+                    symbols[name] = value
+            VGDLParser._symbols = symbols
+        return VGDLParser._symbols
 
     def _eval(self, estr):
         """ 
-        Whatever is visible in the global namespace (after importing the ontologies)
-        can be used in the VGDL, and is evaluated.
-        """        
-        #import gym_vgdl.vgdl.ontology
-        #from .ontology import * #@UnusedWildImport
-        return eval(estr)
+        Ontology symbols are looked up by name, Python literals are parsed,
+        anything else is kept as a string (e.g. sprite type names).
+        """
+        symbols = self._symbolTable()
+        if estr in symbols:
+            return symbols[estr]
+        value = _literal(estr)
+        if isinstance(value, (list, dict, set)):
+            # the cached one must not be shared
+            value = copy.deepcopy(value)
+        return value
 
     def parseInteractions(self, inodes):
         for inode in inodes:
@@ -54,7 +214,7 @@ class VGDLParser(object):
                 eclass, args = self._parseArgs(edef)
                 objs = [x.strip() for x in pair.split(" ") if len(x)>0]
                 for obj in objs[1:]:
-                    self.game.collision_eff.append(tuple([objs[0], obj, eclass, args]))
+                    self._spec['collision_eff'].append(tuple([objs[0], obj, eclass, args]))
                 if self.verbose:
                     print("Collision", pair, "has effect:", edef)
 
@@ -63,7 +223,7 @@ class VGDLParser(object):
             sclass, args = self._parseArgs(tn.content)
             if self.verbose:
                 print("Adding:", sclass, args)
-            self.game.terminations.append(sclass(**args))
+            self._spec['terminations'].append((sclass, args))
 
     def parseSprites(self, snodes, parentclass=None, parentargs={}, parenttypes=[]):
         for sn in snodes:
@@ -73,18 +233,18 @@ class VGDLParser(object):
             stypes = parenttypes+[key]
             if 'singleton' in args:
                 if args['singleton']==True:
-                    self.game.singletons.append(key)
+                    self._spec['singletons'].append(key)
                 args = args.copy()
                 del args['singleton']
 
             if len(sn.children) == 0:
                 if self.verbose:
                     print("Defining:", key, sclass, args, stypes)
-                self.game.sprite_constr[key] = (sclass, args, stypes)
-                if key in self.game.sprite_order:
+                self._spec['sprite_constr'][key] = (sclass, args, stypes)
+                if key in self._spec['sprite_order']:
                     # last one counts
-                    self.game.sprite_order.remove(key)
-                self.game.sprite_order.append(key)
+                    self._spec['sprite_order'].remove(key)
+                self._spec['sprite_order'].append(key)
             else:
                 self.parseSprites(sn.children, sclass, args, stypes)
 
@@ -96,7 +256,7 @@ class VGDLParser(object):
             keys = [x.strip() for x in val.split(" ") if len(x)>0]
             if self.verbose:
                 print("Mapping", c, keys)
-            self.game.char_mapping[c] = keys
+            self._spec['char_mapping'][c] = keys
 
     def _parseArgs(self, s,  sclass=None, args=None):
         if not args:
@@ -105,14 +265,13 @@ class VGDLParser(object):
         if len(sparts) == 0:
             return sclass, args
         if not '=' in sparts[0]:
+            if sparts[0] not in self._symbolTable():
+                raise ValueError("Unknown VGDL class or effect '%s'" % sparts[0])
             sclass = self._eval(sparts[0])
             sparts = sparts[1:]
         for sp in sparts:
             k, val = sp.split("=")
-            try:
-                args[k] = self._eval(val)
-            except:
-                args[k] = val
+            args[k] = self._eval(val)
         return sclass, args
 
 
@@ -129,10 +288,29 @@ class BasicGame(object):
     frame_rate = 25
     render_sprites = True
     load_save_enabled = False
+    # without a display there is no event queue to poll
+    headless = False
+    # the surfaces drawn on, provided by whoever shows the game
+    screen = None
+    background = None
 
     notable_sprites = []
     notable_resources = []
 
+    # tile grid of sprite counts, only maintained after initGrid()
+    grid = None
+
+    # collision rules against groups of at least this many sprites look up
+    # the candidates in a spatial hash of tiles, instead of testing them all
+    hash_min_sprites = 32
+
+    # how many actions keep their KeyState, see _keyState
+    max_keystates = 64
+
+    # update whole groups of plain sprites under grid physics (missiles,
+    # passive and immovable ones) in one loop, without the per-sprite calls
+    batch_movement = False
+
     def __init__(self, **kwargs):
         from .ontology import Immovable, DARKGRAY, MovingAvatar, GOLD
         for name, value in kwargs.items():
@@ -166,6 +344,20 @@ class BasicGame(object):
         self.random_generator = random.Random(self.seed)
         self.is_stochastic = False
         self._lastsaved = None
+        # start state of every level built so far, see buildLevel
+        self._level_prototypes = {}
+        # concrete sprite types below each type, see _concreteKeys
+        self._concrete_keys = {}
+        # sprite types drawn into the static layer, see _bakedKeys
+        self._baked_keys = None
+        # sprite types that _passiveUpdate can move, see _isPassive
+        self._passive_keys = {}
+        # the KeyState of every action seen so far, see _keyState
+        self._keystates = {}
+        # a sprite of every type, as built from its definition, see _spriteTemplate
+        self._templates = {}
+        # collision_eff compiled for _eventHandling, see _interactionTable
+        self._rules = None
         self.reset()
         
         if not self.notable_sprites:
@@ -174,6 +366,10 @@ class BasicGame(object):
 
     def buildLevel(self, lstr):
         from .ontology import stochastic_effects
+        if lstr in self._level_prototypes:
+            self._cloneLevel(lstr)
+            return
+
         lines = [l for l in lstr.split("\n") if len(l)>0]
         lengths = list(map(len, lines))
         assert min(lengths)==max(lengths), "Inconsistent line lengths."
@@ -194,15 +390,25 @@ class BasicGame(object):
                     self.resources_limits[res_type] = args['limit']
 
         # create sprites
+        created = []
         for row, l in enumerate(lines):
             for col, c in enumerate(l):
                 if c in self.char_mapping:
                     pos = (col*self.block_size, row*self.block_size)
-                    self._createSprite(self.char_mapping[c], pos)
+                    created += self._createSprite(self.char_mapping[c], pos) or []
                 elif c in self.default_mapping:
                     pos = (col*self.block_size, row*self.block_size)
-                    self._createSprite(self.default_mapping[c], pos)
-        self.kill_list=[]
+                    created += self._createSprite(self.default_mapping[c], pos) or []
+        self.kill_list=set()
+
+        # remember the start state, so that rebuilding the level is just cloning
+        prototypes = []
+        for s in created:
+            sclass, args, _ = self.sprite_constr[s.name]
+            random_color = not args.get('color') and not sclass.color
+            prototypes.append((self._cloneSprite(s), random_color))
+        self._level_prototypes[lstr] = (self.width, self.height, prototypes)
+
         for _, _, effect, _ in self.collision_eff:
             if effect in stochastic_effects:
                 self.is_stochastic = True
@@ -210,28 +416,251 @@ class BasicGame(object):
         # guarantee that avatar is always visible
         self.sprite_order.remove('avatar')
         self.sprite_order.append('avatar')
-        
-
-    def reset(self):
+        self._concrete_keys = {}
+        self._baked_keys = None
+        self._ordered = None
+        self._layer = None
+
+    def _cloneLevel(self, lstr):
+        """ Rebuild the start state of an already built level from its prototype sprites. """
+        self.width, self.height, prototypes = self._level_prototypes[lstr]
+        self.screensize = (self.width*self.block_size, self.height*self.block_size)
+        for proto, random_color in prototypes:
+            s = self._cloneSprite(proto)
+            if random_color:
+                # draw the color like the constructor would, to keep the random sequence
+                choice = self.random_generator.choice
+                s.color = (choice(s.COLOR_DISC), choice(s.COLOR_DISC), choice(s.COLOR_DISC))
+            self._addSprite(s)
+        self.kill_list=set()
+
+    def _cloneSprite(self, proto):
+        """ A copy of the sprite with its own rects, physics and resources. """
+        s = object.__new__(proto.__class__)
+        s.__dict__.update(proto.__dict__)
+        s.rect = proto.rect.copy()
+        if proto.lastrect is proto.rect:
+            s.lastrect = s.rect
+        else:
+            s.lastrect = proto.lastrect.copy()
+        s.physics = copy.copy(proto.physics)
+        s.resources = defaultdict(lambda: 0, proto.resources)
+        return s
+
+    def get_state(self):
+        """ A snapshot of everything that changes while playing, for set_state.
+        Sprites are kept as copies of their attributes, with their own rects
+        and resources (physics objects don't change, so they are shared),
+        the tile grid (see initGrid) as a copy of the array. """
+        groups = []
+        for key, group in self.sprite_groups.items():
+            copies = []
+            for s in group:
+                d = s.__dict__.copy()
+                d['rect'] = s.rect.copy()
+                if s.lastrect is s.rect:
+                    d['lastrect'] = d['rect']
+                else:
+                    d['lastrect'] = s.lastrect.copy()
+                d['resources'] = dict(s.resources) if s.resources else None
+                if s.rect is not s._hashrect:
+                    d['_hashcells'] = self._hashCells(s.rect)
+                copies.append((s.__class__, d))
+            groups.append((key, copies))
+        # kills of the current tick, as positions in the groups
+        killed = [(s.name, self.sprite_groups[s.name].index(s)) for s in self.kill_list]
+        return {'groups': groups,
+                'killed': killed,
+                'score': self.score,
+                'time': self.time,
+                'ended': self.ended,
+                'num_sprites': self.num_sprites,
+                'next_serial': self._next_serial,
+                'grid': None if self.grid is None else self.grid.copy(),
+                'random': self.random_generator.getstate(),
+                }
+
+    def encode_state(self, state=None):
+        """ A state (by default the current one) as compact bytes, see codec.encodeState. """
+        if state is None:
+            state = self.get_state()
+        return encodeState(self, state)
+
+    def decode_state(self, data):
+        """ The state for set_state back from encode_state's bytes. """
+        return decodeState(self, data)
+
+    def _spriteTemplate(self, key):
+        """ A sprite of type key as it comes out of the constructor, built without
+        touching the game's random generator. """
+        s = self._templates.get(key)
+        if s is None:
+            sclass, args, stypes = self.sprite_constr[key]
+            s = sclass(pos=(0, 0), size=(self.block_size, self.block_size),
+                       name=key, random_generator=random.Random(0), **args)
+            s.stypes = stypes
+            self._templates[key] = s
+        return s
+
+    def set_state(self, state):
+        """ Go back to a snapshot of get_state, which can be restored any number of times. """
+        grid = state['grid']
+        if self.grid is not None and (grid is None or grid.shape != self.grid.shape):
+            # the grid counts have to be built sprite by sprite
+            grid = None
+            self.reset()
+        self._restoreSprites(state, grid)
+        if grid is not None and self.grid is not None:
+            np.copyto(self.grid, grid)
+        self._next_serial = state['next_serial']
+        self.kill_list = set(self.sprite_groups[key][i] for key, i in state['killed'])
+        self.score = state['score']
+        self.time = state['time']
+        self.ended = state['ended']
+        self.num_sprites = state['num_sprites']
+        self.random_generator.setstate(state['random'])
+
+    def _restoreSprites(self, state, grid):
+        """ The sprites of a state. Sprites that are still in their group (by
+        serial) get their attributes replaced, and only move in the spatial hash
+        when they changed tiles; the others are built again. """
+        self._resetTracking()
+        spatial, movers = self._hash, self._hash_movers
+        forget = self._forgetSprite
+        old_groups = self.sprite_groups
+        self.sprite_groups = defaultdict(list)
+        for key, copies in state['groups']:
+            # both lists are in serial order
+            old = old_groups.pop(key, ())
+            i, n = 0, len(old)
+            group = self.sprite_groups[key]
+            for sclass, d in copies:
+                attrs = d.copy()
+                attrs['rect'] = attrs['_hashrect'] = rect = d['rect'].copy()
+                if d['lastrect'] is not d['rect']:
+                    attrs['lastrect'] = d['lastrect'].copy()
+                else:
+                    attrs['lastrect'] = rect
+                cells = attrs['_hashcells']
+                serial = d['_serial']
+                while i < n and old[i]._serial < serial:
+                    forget(old[i])
+                    i += 1
+                if i < n and old[i]._serial == serial:
+                    s = old[i]
+                    i += 1
+                    resources = s.resources
+                    if resources:
+                        resources.clear()
+                    if d['resources']:
+                        resources.update(d['resources'])
+                    attrs['resources'] = resources
+                    if cells != s._hashcells:
+                        for c in s._hashcells:
+                            spatial[c].discard(s)
+                        for c in cells:
+                            spatial[c].add(s)
+                    s.__dict__ = attrs
+                else:
+                    # the bookkeeping of _addSprite
+                    s = object.__new__(sclass)
+                    # int is a cheaper default than a new lambda for every sprite
+                    attrs['resources'] = defaultdict(int, d['resources'] or ())
+                    s.__dict__ = attrs
+                    for c in cells:
+                        spatial[c].add(s)
+                    if not s.is_static:
+                        movers.add(s)
+                    if self.grid is not None:
+                        if grid is None:
+                            self._gridAdd(s)
+                        elif self._gridChannels(s) and not s.is_static:
+                            self._grid_movers.add(s)
+                group.append(s)
+            for s in old[i:]:
+                forget(s)
+            # the live counts of _addSprite, for the whole group at once
+            if group:
+                for stype in group[0].stypes:
+                    self._live_counts[stype] += len(group)
+                    self._member_counts[stype] += len(group)
+                    self._live_versions[stype] += 1
+        for group in old_groups.values():
+            for s in group:
+                forget(s)
+
+    def _forgetSprite(self, s):
+        """ Take a sprite that is no longer in the groups out of the hash and grid. """
+        self._hashRemove(s)
+        if self.grid is not None:
+            self._grid_movers.discard(s)
+
+    def reset(self, seed=None):
+        """ Empty the game for building a level. With a seed, the random
+        generator starts over too, which makes the episode reproducible. """
+        if seed is not None:
+            self.seed = seed
+            self.random_generator.seed(seed)
         self.score = 0
         self.time = 0
         self.ended = False
         self.sprite_groups = defaultdict(list)
         self.num_sprites = 0
-        self.kill_list=[]
-        #self.random_generator = random.Random(self.seed)
+        self.kill_list=set()
+        # spatial hash: tile -> sprites overlapping it
+        self._hash = defaultdict(set)
+        self._hash_movers = set()
+        # sprites are numbered in creation order, which is also their order in the groups
+        self._next_serial = 0
+        self._resetTracking()
+        if self.grid is not None:
+            self.grid.fill(0)
+            self._grid_movers = set()
+
+    def _resetTracking(self):
+        """ Forget the counts and drawing state kept about the sprites. """
+        # per sprite type (abstract ones too): number of live sprites, and a
+        # version that changes whenever the set of live sprites does
+        self._live_counts = defaultdict(int)
+        self._live_versions = defaultdict(int)
+        # per sprite type: number of sprites in the groups, killed ones included
+        self._member_counts = defaultdict(int)
+        # live sprite lists by type, valid as long as the version matches
+        self._live_sprites = {}
+        # the kills in kill_list that are already taken off the counts
+        self._counted_kills = (self.kill_list, set())
+        # all sprites in drawing order, see _orderedSprites
+        self._ordered = None
+        self._split = None
+        # the background with the static sprites drawn in, see _syncLayer,
+        # the rects of it that need redrawing, and where its sprites are
+        self._layer = None
+        self._layer_dirty = []
+        self._baked_rects = {}
+        # the other sprites, with their rect and look when last drawn,
+        # and the rects of the ones that died since
+        self._drawn = {}
+        self._erase = []
+        # the screen everything is drawn on, None when it is out of date
+        self._drawn_screen = None
+        # screen rects changed since _takeDirtyRects, None for all of it
+        self._dirty_rects = None
+        # last outcome of the terminations that only depend on live counts,
+        # with the versions of the counts it was computed for
+        self._done_cache = {}
 
 
     # Returns a list of empty grid cells
     def emptyBlocks(self):
-        alls = [s for s in self]
+        # only the sprites hashed on a tile can overlap it
+        self._hashSync()
         res = []
         for col in range(self.width):
             for row in range(self.height):
                 r = pygame.Rect((col*self.block_size, row*self.block_size),
                                 (self.block_size, self.block_size))
                 free = True
-                for s in alls:
+                for s in self._hash.get((col, row), ()):
                     if r.colliderect(s.rect):
                         free = False
                         break
@@ -264,14 +693,31 @@ class BasicGame(object):
             s = sclass(pos=pos, size=(self.block_size, self.block_size),
                 name=key, random_generator=self.random_generator, **args)
             s.stypes = stypes
-            self.sprite_groups[key].append(s)
-            self.num_sprites += 1
+            self._addSprite(s)
             if s.is_stochastic:
                 self.is_stochastic = True
             res.append(s)
         return res
 
 
+    def _addSprite(self, s):
+        """ Bookkeeping for a new sprite. """
+        self.sprite_groups[s.name].append(s)
+        self.num_sprites += 1
+        self._ordered = None
+        s._serial = self._next_serial
+        self._next_serial += 1
+        for key in s.stypes:
+            self._live_counts[key] += 1
+            self._live_versions[key] += 1
+            self._member_counts[key] += 1
+        self._hashAdd(s)
+        if self.grid is not None:
+            self._gridAdd(s)
+        if self._layer is not None and s.name in self._bakedKeys():
+            self._layer_dirty.append(s.rect.copy())
+
+
     def __iter__(self):
         """ Iterator over all sprites (ordered) """
         for key in self.sprite_order:
@@ -281,26 +727,55 @@ class BasicGame(object):
             for s in self.sprite_groups[key]:
                 yield s
 
+    def _countKills(self):
+        """ Take the sprites added to kill_list since the last call off the live counts. """
+        kill_list, counted = self._counted_kills
+        if kill_list is not self.kill_list:
+            kill_list, counted = self.kill_list, set()
+        if len(counted) != len(kill_list):
+            for s in kill_list - counted:
+                for key in s.stypes:
+                    self._live_counts[key] -= 1
+                    self._live_versions[key] += 1
+            counted = set(kill_list)
+        self._counted_kills = (kill_list, counted)
+
+    def _concreteKeys(self, key):
+        """ The concrete sprite types that are key or below it, in sprite_order. """
+        keys = self._concrete_keys.get(key)
+        if keys is None:
+            keys = [k for k in self.sprite_order
+                    if k in self.sprite_constr and key in self.sprite_constr[k][2]]
+            self._concrete_keys[key] = keys
+        return keys
+
     def numSprites(self, key):
-        """ Abstract sprite groups are computed on demand only """
-        deleted = len([s for s in self.kill_list if key in s.stypes])
-        if key in self.sprite_groups:
-            return len(self.sprite_groups[key])-deleted
-        else:
-            return len([s for s in self if key in s.stypes])-deleted
+        """ Live sprites of a type, abstract or not """
+        self._countKills()
+        return self._live_counts[key]
 
     def getSprites(self, key):
-        if key in self.sprite_groups:
-            return [s for s in self.sprite_groups[key] if s not in self.kill_list]
-        else:
-            return [s for s in self if key in s.stypes and s not in self.kill_list]
+        """ The live sprites of a type, in drawing order. The list is shared
+        between calls until the sprites of that type change, don't modify it. """
+        self._countKills()
+        version = self._live_versions[key]
+        cached = self._live_sprites.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        killed = self.kill_list
+        res = []
+        for k in self._concreteKeys(key):
+            if k in self.sprite_groups:
+                res.extend([s for s in self.sprite_groups[k] if s not in killed])
+        self._live_sprites[key] = (version, res)
+        return res
 
     def getAvatars(self):
         """ The currently alive avatar(s) """
         res = []
-        for ss in self.sprite_groups.values():
+        for key, ss in self.sprite_groups.items():
             if ss and isinstance(ss[0], Avatar):
-                res.extend([s for s in ss if s not in self.kill_list])
+                res.extend(self.getSprites(key))
         return res
 
 
@@ -374,6 +849,51 @@ class BasicGame(object):
                 state.append(object_att)
         return state
 
+    def fillObservation(self, out, mask):
+        """ Same rows as getObservation, but written into the preallocated float32
+        array out of shape (capacity, lenObservation()). Rows beyond the number of
+        objects are zeroed, mask flags the valid ones, and objects that do not fit
+        are dropped. Returns the number of valid rows.
+        out and mask are expected to be zeros, or what the last call left in them:
+        only the rows mask flags are cleared. """
+        capacity = out.shape[0]
+        first_resource = 4 + len(self.notable_sprites)
+        resources = list(enumerate(self.notable_resources, first_resource))
+        block_size = float(self.block_size)
+        previous = int(np.count_nonzero(mask))
+        out[:previous, 4:first_resource] = 0
+        # item assignment on a memoryview is cheaper than on the array itself
+        cells = memoryview(out)
+        n = 0
+        for i, key in enumerate(self.notable_sprites, 4):
+            for s in self.getSprites(key):
+                if n == capacity:
+                    break
+                rect = s.rect
+                orientation = getattr(s, 'orientation', (0, 0))
+                cells[n, 0] = rect.y / block_size
+                cells[n, 1] = rect.x / block_size
+                cells[n, 2] = orientation[0]
+                cells[n, 3] = orientation[1]
+                cells[n, i] = 1
+                for j, r in resources:
+                    cells[n, j] = s.resources[r]
+                n += 1
+        out[n:previous] = 0
+        mask[:n] = 1
+        mask[n:previous] = 0
+        return n
+
+    def fillImage(self, out):
+        """ Copy the screen into the uint8 array out of shape (height, width, 3). """
+        # pixels3d is a (width, height, 3) view on the surface,
+        # a single transposed copy turns it into a (height, width, 3) frame
+        pixels = pygame.surfarray.pixels3d(self.screen)
+        np.copyto(out, pixels.transpose(1, 0, 2))
+        # the view locks the surface until it is released
+        del pixels
+        return out
+
     def lenObservation(self):
         return 2 + 2 + (len(self.notable_sprites)) + len(self.notable_resources)
 
@@ -403,6 +923,177 @@ class BasicGame(object):
         features = avatar_pos + speed + sprite_distances + resources
         return features
 
+    def initGrid(self, keys=None):
+        """ Start maintaining self.grid, a (height, width, len(keys)) uint8 array
+        that counts the sprites of each type in keys (by default the notable
+        sprites) on every tile. It is kept up to date as sprites spawn, move and
+        die, instead of being rebuilt from scratch. """
+        if keys is None:
+            keys = self.notable_sprites
+        self.grid_keys = list(keys)
+        self.grid = np.zeros((self.height, self.width, len(self.grid_keys)), dtype=np.uint8)
+        # sprite name -> channels it counts towards
+        self._grid_channels = {}
+        # tracked sprites that may move
+        self._grid_movers = set()
+        for s in self:
+            if s not in self.kill_list:
+                self._gridAdd(s)
+
+    def _gridCell(self, s):
+        """ The tile under the center of the sprite, None when off the grid. """
+        row = s.rect.centery // self.block_size
+        col = s.rect.centerx // self.block_size
+        if 0 <= row < self.height and 0 <= col < self.width:
+            return row, col
+        return None
+
+    def _gridChannels(self, s):
+        """ The channels a sprite counts towards. """
+        channels = self._grid_channels.get(s.name)
+        if channels is None:
+            channels = [i for i, key in enumerate(self.grid_keys) if key in s.stypes]
+            self._grid_channels[s.name] = channels
+        return channels
+
+    def _gridAdd(self, s):
+        channels = self._gridChannels(s)
+        if not channels:
+            return
+        s._gridcell = self._gridCell(s)
+        if s._gridcell is not None:
+            self.grid[s._gridcell + (channels,)] += 1
+        if not s.is_static:
+            self._grid_movers.add(s)
+
+    def _gridRemove(self, s):
+        if not self._grid_channels.get(s.name):
+            return
+        if s._gridcell is not None:
+            self.grid[s._gridcell + (self._grid_channels[s.name],)] -= 1
+        self._grid_movers.discard(s)
+
+    def _gridSync(self):
+        """ Move the counts of the sprites that changed tiles during this tick. """
+        for s in self._grid_movers:
+            cell = self._gridCell(s)
+            if cell != s._gridcell:
+                channels = self._grid_channels[s.name]
+                if s._gridcell is not None:
+                    self.grid[s._gridcell + (channels,)] -= 1
+                if cell is not None:
+                    self.grid[cell + (channels,)] += 1
+                s._gridcell = cell
+
+    def _hashCells(self, rect):
+        """ The tiles a rect overlaps. """
+        b = self.block_size
+        left, top = rect.left // b, rect.top // b
+        right, bottom = (rect.right - 1) // b, (rect.bottom - 1) // b
+        if left == right and top == bottom:
+            return ((left, top),)
+        return tuple((col, row) for row in range(top, bottom + 1)
+                     for col in range(left, right + 1))
+
+    def _hashAdd(self, s):
+        s._hashrect = s.rect
+        s._hashcells = self._hashCells(s.rect)
+        for c in s._hashcells:
+            self._hash[c].add(s)
+        if not s.is_static:
+            self._hash_movers.add(s)
+
+    def _hashRemove(self, s):
+        for c in s._hashcells:
+            self._hash[c].discard(s)
+        self._hash_movers.discard(s)
+
+    def _hashMove(self, s):
+        """ Update the tiles of a sprite that may have moved. """
+        s._hashrect = s.rect
+        if s in self._baked_rects and s.rect != self._baked_rects[s]:
+            # a static sprite that moved needs to be drawn again
+            self._layer_dirty.append(self._baked_rects[s])
+            self._layer_dirty.append(s.rect.copy())
+            self._baked_rects[s] = s.rect.copy()
+        cells = self._hashCells(s.rect)
+        if cells != s._hashcells:
+            for c in s._hashcells:
+                self._hash[c].discard(s)
+            for c in cells:
+                self._hash[c].add(s)
+            s._hashcells = cells
+
+    def _hashSync(self):
+        """ Update the tiles of the sprites that moved during the update phase.
+        Moving there always replaces the rect, so sprites that still have
+        the rect they were hashed with can be skipped. """
+        for s in self._hash_movers:
+            if s.rect is not s._hashrect:
+                self._hashMove(s)
+
+    def _hashCollisions(self, s1, g, ranks, limit):
+        """ The sprites of group g that collide with s1, in the order of the
+        group's sprite list (see _eventHandling), found through the spatial hash.
+        ranks is None for concrete groups, otherwise the position of every
+        member sprite type, and limit the first serial not in the list. """
+        candidates = set()
+        for c in self._hashCells(s1.rect):
+            cell = self._hash.get(c)
+            if cell:
+                candidates.update(cell)
+        rect = s1.rect
+        if ranks is None:
+            hits = [s for s in candidates if s.name == g and rect.colliderect(s.rect)]
+            hits.sort(key=lambda s: s._serial)
+        else:
+            hits = [s for s in candidates if s.name in ranks and s._serial < limit
+                    and rect.colliderect(s.rect)]
+            hits.sort(key=lambda s: (ranks[s.name], s._serial))
+        return hits
+
+    def _isPassive(self, key):
+        """ Whether the sprites of this type just move along under grid physics,
+        'static' if they don't even do that. """
+        passive = self._passive_keys.get(key)
+        if passive is None:
+            from .ontology import GridPhysics
+            sclass, args, _ = self.sprite_constr[key]
+            physicstype = args.get('physicstype') or sclass.physicstype or GridPhysics
+            passive = (sclass.update is VGDLSprite.update
+                       and sclass._updatePos is VGDLSprite._updatePos
+                       and physicstype is GridPhysics)
+            if passive and 'is_static' not in args and 'only_active' not in args \
+                    and (sclass.is_static or sclass.only_active):
+                passive = 'static'
+            self._passive_keys[key] = passive
+        return passive
+
+    def _passiveUpdate(self, group, static=False):
+        """ VGDLSprite.update for a group of sprites under plain grid physics,
+        with GridPhysics.passiveMovement and VGDLSprite._updatePos inlined. """
+        if static:
+            for s in group:
+                s.lastrect = s.rect
+                s.lastmove += 1
+            return
+        for s in group:
+            s.lastrect = rect = s.rect
+            s.lastmove += 1
+            if s.is_static or s.only_active:
+                continue
+            speed = s.speed
+            if speed is None:
+                speed = 1
+            if speed == 0 or not hasattr(s, 'orientation'):
+                continue
+            o = s.orientation
+            if s.cooldown > s.lastmove or abs(o[0]) + abs(o[1]) == 0:
+                continue
+            speed = speed * s.physics.gridsize[0]
+            s.rect = rect.move((o[0] * speed, o[1] * speed))
+            s.lastmove = 0
+
     def _getDistance(self, s1, s2):
         return math.hypot(s1.rect.x - s2.rect.x, s1.rect.y - s2.rect.y)
 
@@ -410,70 +1101,237 @@ class BasicGame(object):
         return 2 + 1 + len(self.notable_sprites) + len(self.notable_resources)
 
 
-    # Clears sprite from screen and removes dead sprites
-    def _clearAll(self, onscreen=True):
-        for s in set(self.kill_list):
-            if onscreen:
-                s._clear(self.screen, self.background, double=True)
-            self.sprite_groups[s.name].remove(s)
-        if onscreen:
-            for s in self:
-                s._clear(self.screen, self.background)
-        self.kill_list = []
-
-    def _drawAll(self):
-        for s in self:
-            s._draw(self)
+    # Removes dead sprites, remembering where they have to be cleared from the screen
+    def _clearAll(self):
+        # the dead are already off the live counts
+        self._countKills()
+        dead = self.kill_list
+        names = set()
+        for s in dead:
+            if s in self._baked_rects:
+                self._layer_dirty.append(self._baked_rects.pop(s))
+            elif s in self._drawn:
+                self._erase.append(self._drawn.pop(s)[0])
+            names.add(s.name)
+            self._hashRemove(s)
+            if self.grid is not None:
+                self._gridRemove(s)
+        # one pass per group, keeping the order of the survivors
+        for name in names:
+            group = self.sprite_groups[name]
+            survivors = []
+            for s in group:
+                if s in dead:
+                    for key in s.stypes:
+                        self._member_counts[key] -= 1
+                else:
+                    survivors.append(s)
+            group[:] = survivors
+        if dead:
+            self._ordered = None
+        self.kill_list = set()
+
+    def _orderedSprites(self):
+        """ All sprites in drawing order, as a list that is only rebuilt
+        after sprites were added or removed. Unlike iterating over the game,
+        it does not pick up sprites created while going through it. """
+        if self._ordered is None:
+            self._ordered = [s for key in self.sprite_order if key in self.sprite_groups
+                             for s in self.sprite_groups[key]]
+        return self._ordered
+
+    def _bakedKeys(self):
+        """ The static sprite types that come before all others in sprite_order.
+        They are drawn once into the static layer, instead of on every tick. """
+        if self._baked_keys is None:
+            self._baked_keys = set()
+            for key in self.sprite_order:
+                if key not in self.sprite_constr:
+                    continue
+                sclass, args, _ = self.sprite_constr[key]
+                if not args.get('is_static', sclass.is_static):
+                    break
+                self._baked_keys.add(key)
+        return self._baked_keys
+
+    def _splitSprites(self):
+        """ The sprites in drawing order, split into those in the static layer
+        and the others, as lists that live as long as the _orderedSprites one. """
+        ordered = self._orderedSprites()
+        if self._split is None or self._split[0] is not ordered:
+            baked = self._bakedKeys()
+            self._split = (ordered, [s for s in ordered if s.name in baked],
+                           [s for s in ordered if s.name not in baked])
+        return self._split[1], self._split[2]
+
+    def _drawOn(self, surface, sprites):
+        # sprites draw on the game's screen
+        screen, self.screen = self.screen, surface
+        try:
+            for s in sprites:
+                s._draw(self)
+        finally:
+            self.screen = screen
+
+    def _syncLayer(self):
+        """ Bring the static layer up to date. Returns the rects that changed,
+        or None when it was drawn from scratch. """
+        if self._layer is None or self._layer_background is not self.background:
+            baked, _ = self._splitSprites()
+            self._layer = self.background.copy()
+            self._layer_background = self.background
+            self._drawOn(self._layer, baked)
+            self._baked_rects = {s: s.rect.copy() for s in baked}
+            self._layer_dirty = []
+            return None
+        rects = self._layer_dirty
+        if rects:
+            baked, _ = self._splitSprites()
+            bakedrects = [s.rect for s in baked]
+            layer = self._layer
+            for r in rects:
+                layer.set_clip(r)
+                layer.blit(self.background, r, r)
+                self._drawOn(layer, [baked[i] for i in r.collidelistall(bakedrects)])
+            layer.set_clip(None)
+            for s in baked:
+                if s not in self._baked_rects:
+                    self._baked_rects[s] = s.rect.copy()
+            self._layer_dirty = []
+        return rects
+
+    def _redrawAll(self):
+        """ Repaint the whole screen, instead of only what changed since the last tick. """
+        self._syncLayer()
+        _, others = self._splitSprites()
+        self.screen.blit(self._layer, (0, 0))
+        self._drawOn(self.screen, others)
+        self._drawn = {s: (s.rect.copy(), s._look()) for s in others}
+        self._erase = []
+        self._drawn_screen = self.screen
+        self._dirty_rects = None
+
+    def _drawChanged(self):
+        """ Repaint the rects of the screen where sprites moved, changed,
+        appeared or disappeared since the last time it was drawn. """
+        rects = self._syncLayer()
+        if rects is None or self._drawn_screen is not self.screen:
+            self._redrawAll()
+            return
+        rects.extend(self._erase)
+        self._erase = []
+        _, others = self._splitSprites()
+        drawn = self._drawn
+        for s in others:
+            look = s._look()
+            last = drawn.get(s)
+            if last is None or last[0] != s.rect or last[1] != look:
+                rect = s.rect.copy()
+                drawn[s] = (rect, look)
+                if last is not None:
+                    # one rect for short moves, two for jumps
+                    union = last[0].union(rect)
+                    if union.w * union.h <= 2 * rect.w * rect.h:
+                        rect = union
+                    else:
+                        rects.append(last[0])
+                rects.append(rect)
+        screen = self.screen
+        otherrects = [s.rect for s in others]
+        for r in rects:
+            screen.set_clip(r)
+            screen.blit(self._layer, r, r)
+            self._drawOn(screen, [others[i] for i in r.collidelistall(otherrects)])
+        screen.set_clip(None)
+        if self._dirty_rects is not None and not self.headless:
+            self._dirty_rects.extend(rects)
+
+    def _takeDirtyRects(self):
+        """ The screen rects that changed since the last call, None if that may be all of them. """
+        rects = self._dirty_rects
+        self._dirty_rects = []
+        return rects
 
     def _updateCollisionDict(self, changedsprite):
         for key in changedsprite.stypes:
             if key in self.lastcollisions:
                 del self.lastcollisions[key]
 
+    def _interactionTable(self):
+        """ collision_eff as a list of (g1, g2, effect, kwargs, score) rules, with
+        the score change taken out of the arguments that go to the effect.
+        It is compiled again when collision_eff is replaced or grows. """
+        rules = self._rules
+        if rules is None or rules[0] is not self.collision_eff or len(rules[1]) != len(self.collision_eff):
+            table = []
+            for g1, g2, effect, kwargs in self.collision_eff:
+                kwargs = dict(kwargs)
+                score = kwargs.pop('scoreChange', 0)
+                table.append((g1, g2, effect, kwargs, score))
+            rules = self._rules = (self.collision_eff, table)
+        return rules[1]
+
     def _eventHandling(self):
         self.lastcollisions = {}
         ss = self.lastcollisions
-        for g1, g2, effect, kwargs in self.collision_eff:
+        # how to find the members of each list in ss through the spatial hash
+        members = {}
+        screen = pygame.Rect((0,0), self.screensize)
+        for g1, g2, effect, kwargs, score in self._interactionTable():
             # build the current sprite lists (if not yet available)
-            for g in [g1, g2]:
+            for g in (g1, g2):
                 if g not in ss:
                     if g in self.sprite_groups:
                         tmp = self.sprite_groups[g]
+                        members[g] = (None, None)
                     else:
                         tmp = []
-                        for key in self.sprite_groups:
-                            v = self.sprite_groups[key]
-                            if v and g in v[0].stypes:
-                                tmp.extend(v)
+                        ranks = {}
+                        # no need to look through the groups for an empty type
+                        if self._member_counts[g]:
+                            for key in self.sprite_groups:
+                                v = self.sprite_groups[key]
+                                if v and g in v[0].stypes:
+                                    tmp.extend(v)
+                                    ranks[key] = len(ranks)
+                        members[g] = (ranks, self._next_serial)
                     ss[g] = (tmp, len(tmp))
 
             # special case for end-of-screen
             if g2 == "EOS":
                 ss1, l1 = ss[g1]
                 for s1 in ss1:
-                    if not pygame.Rect((0,0), self.screensize).contains(s1.rect):
+                    if not screen.contains(s1.rect):
                         effect(s1, None, self, **kwargs)
+                        self._hashMove(s1)
                 continue
 
-            # iterate over the shorter one
+            # nothing can collide when either side is empty
             ss1, l1 = ss[g1]
             ss2, l2 = ss[g2]
+            if not ss1 or not ss2:
+                continue
+
+            # iterate over the shorter one
             if l1 < l2:
                 shortss, longss, switch = ss1, ss2, False
+                longg = g2
             else:
                 shortss, longss, switch = ss2, ss1, True
-
-            # score argument is not passed along to the effect function
-            score = 0
-            if 'scoreChange' in kwargs:
-                kwargs = kwargs.copy()
-                score = kwargs['scoreChange']
-                del kwargs['scoreChange']
+                longg = g1
+            if len(longss) >= self.hash_min_sprites:
+                ranks, limit = members[longg]
+            else:
+                ranks, limit = None, None
+                longg = None
 
             # do collision detection
             for s1 in shortss:
-                for ci in s1.rect.collidelistall(longss):
-                    s2 = longss[ci]
+                if longg is None:
+                    hits = [longss[ci] for ci in s1.rect.collidelistall(longss)]
+                else:
+                    hits = self._hashCollisions(s1, longg, ranks, limit)
+                for s2 in hits:
                     if s1 == s2:
                         continue
                     # deal with the collision effects
@@ -487,50 +1345,148 @@ class BasicGame(object):
                         # CHECKME: this is not a bullet-proof way, but seems to work
                         if s1 not in self.kill_list:
                             effect(s1, s2, self, **kwargs)
+                    # the effect may have moved either of them
+                    self._hashMove(s1)
+                    self._hashMove(s2)
 
 
     def getPossibleActions(self):
         return self.getAvatars()[0].declare_possible_actions()
 
 
+    def _isDone(self, t):
+        """ t.isDone, only evaluated again when one of the counts it watches changed. """
+        stypes = t.watchedTypes()
+        if stypes is None:
+            return t.isDone(self)
+        versions = tuple([self._live_versions[key] for key in stypes])
+        cached = self._done_cache.get(t)
+        if cached is None or cached[0] != versions:
+            cached = self._done_cache[t] = (versions, t.isDone(self))
+        return cached[1]
+
+    def _keyState(self, action):
+        """ The KeyState for an action, which is either a key (0 for none),
+        a direction to hand straight to the avatar, or the state of all keys
+        (e.g. pygame.key.get_pressed()). Keys and directions share theirs. """
+        if isinstance(action, KeyState):
+            return action
+        if isinstance(action, tuple) and len(action) == 2:
+            key = action
+        elif isinstance(action, numbers.Integral):
+            key = int(action)
+        else:
+            return PressedKeys(action)
+        keystate = self._keystates.get(key)
+        if keystate is None:
+            if len(self._keystates) >= self.max_keystates:
+                self._keystates.clear()
+            if isinstance(key, tuple):
+                keystate = KeyState(directions=[key] if any(key) else [])
+            else:
+                keystate = KeyState([key])
+            self._keystates[key] = keystate
+        return keystate
+
     def tick(self, action, render = True):
 
         # This is required for game-updates to work properly
         self.time += 1
 
         # Flush events
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
+        if not self.headless:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    sys.exit()
 
         # Update Keypresses
         # Agents are updated during the update routine in their ontology files, this demends on BasicGame.keystate
-        self.keystate = [0]*323 #323 seems to be the magic number..... (try len(pygame.key.get_pressed()))
-        self.keystate[action] = True
+        self.keystate = self._keyState(action)
 
         # Iterate Over Termination Criteria
+        self._countKills()
         for t in self.terminations:
-            self.ended, win = t.isDone(self)
+            self.ended, win = self._isDone(t)
             if self.ended:
                 return
 
             if self.time > 1000:
                 self.ended = True
 
-        # Update Sprites
-        for s in self:
-            s.update(self)
+        # Update Sprites (sprites spawned meanwhile are updated too,
+        # if their group comes later or is the current one)
+        for key in self.sprite_order:
+            if key in self.sprite_groups:
+                if self.batch_movement and self._isPassive(key):
+                    self._passiveUpdate(self.sprite_groups[key], self._isPassive(key) == 'static')
+                else:
+                    for s in self.sprite_groups[key]:
+                        s.update(self)
+        self._hashSync()
         
         # Handle Collision Effects
         self._eventHandling()
 
         # Clean up dead sprites
         self._clearAll()
-        
-        #if render:
-        self._drawAll()
-        #pygame.display.update()
+
+        if self.grid is not None:
+            self._gridSync()
+
+        if render:
+            self._drawChanged()
+        else:
+            self._drawn_screen = None
+
+    def replay(self, lstr, actions, seed=None, ticks=None, frames=False,
+               repeat=1, pool=False):
+        """ Play level lstr again from its start (see reset for the seed) with
+        logged actions, as taken by tick. Nothing is drawn and no observations
+        are built along the way; only after the ticks asked for (all if None,
+        0 is the start of the level) the state is captured and yielded as
+        (tick, get_state()), or with frames as (tick, (height, width, 3) image).
+        Stops early when the game ends.
+        Every action is taken for repeat ticks in a row (fewer when the game
+        ends), and ticks then count actions. With pool, frames are the pixelwise
+        maximum of the last two frames of an action, as with VGDLEnv's max_pool. """
+        self.reset(seed)
+        self.buildLevel(lstr)
+        wanted = None if ticks is None else set(ticks)
+        last = None if wanted is None else max(wanted) if wanted else -1
+        # no events to look at either
+        headless, self.headless = self.headless, True
+        try:
+            if wanted is None or 0 in wanted:
+                yield 0, self._capture(frames)
+            for t, action in enumerate(actions, 1):
+                if self.ended or (last is not None and t > last):
+                    break
+                capture = wanted is None or t in wanted
+                pooled = None
+                for i in range(repeat):
+                    self.tick(action, render=False)
+                    if self.ended:
+                        break
+                    if pool and frames and capture and i == repeat - 2:
+                        pooled = self._capture(frames)
+                if capture:
+                    state = self._capture(frames)
+                    if pooled is not None:
+                        np.maximum(state, pooled, out=state)
+                    yield t, state
+        finally:
+            self.headless = headless
+
+    def _capture(self, frame):
+        if not frame:
+            return self.get_state()
+        if self.screen is None:
+            self.screen = pygame.Surface(self.screensize)
+            self.background = pygame.Surface(self.screensize)
+        self._redrawAll()
+        width, height = self.screensize
+        return self.fillImage(np.empty((height, width, 3), np.uint8))
 
 
 
@@ -538,7 +1494,6 @@ class VGDLSprite(object):
     """ Base class for all sprite types. """
     name = None
     COLOR_DISC = [20,80,140,200]
-    dirtyrects = []
 
     is_static= False
     only_active =False
@@ -632,8 +1587,6 @@ class VGDLSprite(object):
             screen.fill(self.color, shrunk)
         if self.resources:
             self._drawResources(game, screen, shrunk)
-        #r = self.rect.copy()
-        #VGDLSprite.dirtyrects.append(r)
 
     def _drawResources(self, game, screen, rect):
         """ Draw progress bars on the bottom third of the sprite """
@@ -651,18 +1604,40 @@ class VGDLSprite(object):
                 screen.fill(BLACK, rest)
                 offset += barheight
 
-    def _clear(self, screen, background, double=True):
-        pass
-        r = screen.blit(background, self.rect, self.rect)
-        #VGDLSprite.dirtyrects.append(r)
-        if double:
-            r = screen.blit(background, self.lastrect, self.lastrect)
-        #    VGDLSprite.dirtyrects.append(r)
+    def _look(self):
+        """ Everything besides the rect that decides how the sprite is drawn. """
+        return (self.color, self.img, self.shrinkfactor,
+                tuple(self.resources.items()) if self.resources else None)
 
     def __repr__(self):
         return self.name+" at (%s,%s)"%(self.rect.left, self.rect.top)
 
 
+class KeyState(object):
+    """ The keys pressed during a tick, indexed like pygame.key.get_pressed().
+    It may also carry the directions for the avatar directly, when the
+    action did not come from the keyboard. """
+    def __init__(self, keys=(), directions=None):
+        self.keys = frozenset(keys)
+        self.directions = directions
+        # directions decoded from the keys, by avatar key layout
+        self.decoded = {}
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+
+class PressedKeys(KeyState):
+    """ A KeyState that reads the keys from the state of the keyboard
+    (e.g. pygame.key.get_pressed()), for one tick. """
+    def __init__(self, pressed):
+        KeyState.__init__(self)
+        self.pressed = pressed
+
+    def __getitem__(self, key):
+        return bool(self.pressed[key])
+
+
 class Avatar(object):
     """ Abstract superclass of all avatars. """
     shrinkfactor=0.15
@@ -686,10 +1661,15 @@ class Resource(VGDLSprite):
 
 class Termination(object):
     """ Base class for all termination criteria. """
+    def watchedTypes(self):
+        """ The sprite types whose live counts alone decide isDone,
+        or None if it needs to be checked on every tick. """
+        return None
+
     def isDone(self, game):
         """ returns whether the game is over, with a win/lose flag """
         from pygame.locals import K_ESCAPE, QUIT
-        if game.keystate[K_ESCAPE] or pygame.event.peek(QUIT):
+        if game.keystate[K_ESCAPE] or (not game.headless and pygame.event.peek(QUIT)):
             return True, False
         else:
             return False, None
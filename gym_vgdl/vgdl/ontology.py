@@ -192,6 +192,9 @@ class OrientedSprite(VGDLSprite):
     draw_arrow = False
     orientation = RIGHT
 
+    def _look(self):
+        return VGDLSprite._look(self) + (self.orientation,)
+
     def _draw(self, game):
         """ With a triangle that shows the orientation. """
         VGDLSprite._draw(self, game)
@@ -436,18 +439,28 @@ class MovingAvatar(VGDLSprite, Avatar):
 
     def _readMultiActions(self, game):
         """ Read multiple simultaneously pressed button actions. """
+        keystate = game.keystate
+        if keystate.directions is not None:
+            return list(keystate.directions)
+        res = keystate.decoded.get(self.alternate_keys)
+        if res is None:
+            res = keystate.decoded[self.alternate_keys] = self._decodeKeys(keystate)
+        return list(res)
+
+    def _decodeKeys(self, keystate):
+        """ The directions of the pressed keys. """
         from pygame.locals import K_LEFT, K_RIGHT, K_UP, K_DOWN, K_a, K_s, K_d, K_w
         res = []
         if self.alternate_keys:
-            if   game.keystate[K_d]: res += [RIGHT]
-            elif game.keystate[K_a]:  res += [LEFT]
-            if   game.keystate[K_w]:    res += [UP]
-            elif game.keystate[K_s]:  res += [DOWN]
+            if   keystate[K_d]: res += [RIGHT]
+            elif keystate[K_a]:  res += [LEFT]
+            if   keystate[K_w]:    res += [UP]
+            elif keystate[K_s]:  res += [DOWN]
         else:
-            if   game.keystate[K_RIGHT]: res += [RIGHT]
-            elif game.keystate[K_LEFT]:  res += [LEFT]
-            if   game.keystate[K_UP]:    res += [UP]
-            elif game.keystate[K_DOWN]:  res += [DOWN]
+            if   keystate[K_RIGHT]: res += [RIGHT]
+            elif keystate[K_LEFT]:  res += [LEFT]
+            if   keystate[K_UP]:    res += [UP]
+            elif keystate[K_DOWN]:  res += [DOWN]
         return res
 
     def update(self, game):
@@ -705,6 +718,9 @@ class SpriteCounter(Termination):
         self.stype = stype
         self.win = win
 
+    def watchedTypes(self):
+        return [self.stype]
+
     def isDone(self, game):
         if game.numSprites(self.stype) <= self.limit:
             return True, self.win
@@ -718,6 +734,9 @@ class MultiSpriteCounter(Termination):
         self.win = win
         self.stypes = kwargs.values()
 
+    def watchedTypes(self):
+        return list(self.stypes)
+
     def isDone(self, game):
         if sum([game.numSprites(st) for st in self.stypes]) == self.limit:
             return True, self.win
@@ -730,12 +749,12 @@ class MultiSpriteCounter(Termination):
 # ---------------------------------------------------------------------
 def killSprite(sprite, partner, game):
     """ Kill command """
-    game.kill_list.append(sprite)
+    game.kill_list.add(sprite)
 
 def killBoth(sprite, partner, game):
     """ Kill command """
-    game.kill_list.append(sprite)
-    game.kill_list.append(partner)
+    game.kill_list.add(sprite)
+    game.kill_list.add(partner)
 
 def cloneSprite(sprite, partner, game):
     game._createSprite([sprite.name], (sprite.rect.left, sprite.rect.top))
@@ -755,6 +774,7 @@ def undoAll(sprite, partner, game):
     """ Revert last moves of all sprites. """
     for s in game:
         s.rect = s.lastrect
+        game._hashMove(s)
 
 def bounceForward(sprite, partner, game):
     """ The partner sprite pushed, so if possible move in the opposite direction. """
@@ -1,10 +1,37 @@
 from collections import OrderedDict
+import functools
+import os
 import gym
 from gym import spaces
 from .vgdl import core
 import pygame
 import numpy as np
 from .list_space import list_space
+from .frame_buffer import FrameRingBuffer
+from .recorder import TrajectoryRecorder
+
+
+# Contents of the most recently read game and level files,
+# by path and modification time
+@functools.lru_cache(maxsize=64)
+def _read_cached(path, mtime):
+    with open(path, "r") as myfile:
+        return myfile.read()
+
+def _read_file(path):
+    path = os.path.abspath(path)
+    return _read_cached(path, os.path.getmtime(path))
+
+
+def _obs_spec(env):
+    """ Shape and dtype of every array of an observation of env, by key
+    (a single None key when the observation is just one array). """
+    space = env.observation_space
+    if isinstance(space, spaces.Dict):
+        return OrderedDict((key, (tuple(s.shape), s.dtype))
+                           for key, s in space.spaces.items())
+    dtype = np.uint8 if env._obs_type in ('image', 'grid') else np.float32
+    return OrderedDict([(None, (tuple(space.shape), dtype))])
 
 
 class VGDLEnv(gym.Env):
@@ -17,20 +44,40 @@ class VGDLEnv(gym.Env):
                  game_file = None,
                  level_file = None,
                  obs_type='image',
+                 zero_copy=False,
+                 frame_skip=1,
+                 max_pool=False,
+                 frame_stack=1,
+                 max_objects=None,
                  **kwargs):
 
 
         # Variables
         self._obs_type = obs_type
+        # If set, array observations (images, grids, object tables, stacks)
+        # are read-only views of buffers that get overwritten by the next step
+        self.zero_copy = zero_copy
+        # Repeat every action for frame_skip ticks, optionally
+        # max-pooling the last two frames (image observations only)
+        assert frame_skip >= 1, "frame_skip must be at least 1"
+        assert not max_pool or obs_type == 'image', "max_pool needs image observations"
+        self.frame_skip = frame_skip
+        self.max_pool = max_pool
+        # Observations are the last frame_stack frames, oldest first
+        assert frame_stack == 1 or obs_type != 'objects', "objects observations can not be stacked"
+        self.frame_stack = frame_stack
+        # With max_objects set, 'objects' observations are a fixed-size
+        # float32 table plus a mask of the valid rows, instead of a list
+        self.max_objects = max_objects
         self.viewer = None
+        self.recorder = None
+        self._next_seed = None
         self.game_args = kwargs
         
         # Load game description and level description
         if game_file is not None:
-            with open (game_file, "r") as myfile:
-                game_desc = myfile.read()
-            with open (level_file, "r") as myfile:
-                level_desc = myfile.read()
+            game_desc = _read_file(game_file)
+            level_desc = _read_file(level_file)
             self.loadGame(game_desc, level_desc)
         
          
@@ -48,89 +95,268 @@ class VGDLEnv(gym.Env):
 
         # Set action space and observation space
         self._action_set = OrderedDict(self.game.getPossibleActions())
+        self._action_keys = list(self._action_set.values())
         self.action_space = spaces.Discrete(len(self._action_set))
         
         self.screen_width, self.screen_height = self.game.screensize
         
         if self._obs_type == 'image':
             self.observation_space = spaces.Box(low=0, high=255,
-                    shape=(self.screen_height, self.screen_width, 3) )
-        elif self._obs_type == 'objects':
+                    shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
+        elif self._obs_type == 'objects' and self.max_objects is None:
             # An objects observation consists of a list of observations,
             # one for each sprite (including walls).
             # An observation is [y, x, orient_y, orient_x, *class_one_hot, *resources]
             self.observation_space = list_space( spaces.Box(low=-100, high=100,
                     shape=(self.game.lenObservation(),) ) )
+        elif self._obs_type == 'objects':
+            # Same rows, in a table of max_objects rows of which mask
+            # tells the valid ones
+            shape = (self.max_objects, self.game.lenObservation())
+            self.observation_space = spaces.Dict({
+                    'objects': spaces.Box(low=-100, high=100, shape=shape, dtype=np.float32),
+                    'mask': spaces.Box(low=0, high=1, shape=shape[:1], dtype=np.uint8),
+                    })
+            self._objects = np.zeros(shape, dtype=np.float32)
+            self._mask = np.zeros(shape[:1], dtype=np.uint8)
+            self._objects_view = {'objects': self._objects.view(), 'mask': self._mask.view()}
+            for view in self._objects_view.values():
+                view.flags.writeable = False
         elif self._obs_type == 'features':
             self.observation_space = spaces.Box(low=0, high=100,
                     shape=(self.game.lenFeatures(),) )
+        elif self._obs_type == 'grid':
+            # A grid observation counts the notable sprites on every tile,
+            # with one channel per notable sprite type
+            self.game.initGrid()
+            self.observation_space = spaces.Box(low=0, high=255,
+                    shape=self.game.grid.shape, dtype=np.uint8)
+            self._grid_view = self.game.grid.view()
+            self._grid_view.flags.writeable = False
+
+        if self.frame_stack > 1:
+            space = self.observation_space
+            dtype = np.float32 if self._obs_type == 'features' else np.uint8
+            self._frames = FrameRingBuffer(self.frame_stack, space.shape, dtype)
+            self.observation_space = spaces.Box(
+                    low=np.repeat(space.low[None], self.frame_stack, axis=0),
+                    high=np.repeat(space.high[None], self.frame_stack, axis=0),
+                    dtype=dtype)
 
-        # Keep a Surface for drawing on (screen)
-        # and a bigger one that is actually rendered (display)
+        # Keep an off-screen Surface for drawing on (screen)
+        # and a bigger one that is actually rendered (display).
+        # The display is only opened by the first render(mode='human'),
+        # until then the game runs headless.
         self.zoom = 25 // self.game.block_size
         self.display_size = np.array(self.game.screensize) * self.zoom
-        self.display = pygame.display.set_mode(self.display_size, 0, 32)
+        self.display = None
+        self.game.headless = True
+        # Only image games draw while ticking, the others get
+        # a screen the first time they are rendered
+        self.screen = None
+        self.game.screen = None
+        if self._obs_type == 'image':
+            self._init_screen()
+
+    def _init_screen(self):
         self.screen = pygame.Surface(self.game.screensize)
         self.game.screen = self.screen
         self.game.screen.fill((0, 0, 0))
 
-        # Not sure what the background is needed for, it's not drawn
-        #TODO: get rid of this
+        # The static sprites are drawn onto a copy of the background,
+        # see BasicGame._syncLayer
         self.game.background = pygame.Surface(self.game.screensize)
+
+        # Preallocated, C-contiguous buffer for image observations
+        self._image = np.zeros((self.screen_height, self.screen_width, 3), dtype=np.uint8)
+        self._image_view = self._image.view()
+        self._image_view.flags.writeable = False
+        if self.max_pool:
+            self._pool_image = np.zeros_like(self._image)
         
         
     @property
     def _n_actions(self):
         return len(self._action_set)
 
-    @property
-    def _action_keys(self):
-        return list(self._action_set.values())
-
     def get_action_meanings(self):
         # In the spirit of the Atari environment, describe actions with strings
         return list(self._action_set.keys())
 
     def _draw_screen(self):
-        self.game._drawAll()
+        # Repaint the whole screen, for when the ticks did not draw
+        if self.screen is None:
+            self._init_screen()
+        self.game._redrawAll()
 
     def _update_display(self):
-        # Scale drawn surface onto rendered surface
-        pygame.transform.scale(self.screen, self.display_size, self.display)
-        pygame.display.update()
+        rects = self.game._takeDirtyRects()
+        if self.display is None:
+            self.display = pygame.display.set_mode(self.display_size, 0, 32)
+            self.game.headless = False
+            rects = None
+        if rects is None:
+            # Scale drawn surface onto rendered surface
+            pygame.transform.scale(self.screen, self.display_size, self.display)
+            pygame.display.update()
+            return
+        # Only scale and update the parts that changed
+        bounds = self.screen.get_rect()
+        updated = []
+        for r in rects:
+            r = r.clip(bounds)
+            if r.w and r.h:
+                zoomed = pygame.Rect(r.x * self.zoom, r.y * self.zoom,
+                                     r.w * self.zoom, r.h * self.zoom)
+                pygame.transform.scale(self.screen.subsurface(r), zoomed.size,
+                                       self.display.subsurface(zoomed))
+                updated.append(zoomed)
+        pygame.display.update(updated)
 
-    def _get_image(self):
-        self._draw_screen()
-        return np.flipud(np.rot90(pygame.surfarray.array3d(
-            self.screen).astype(np.uint8)))
+    def _close_display(self):
+        if self.display is not None:
+            pygame.display.quit()
+            self.display = None
+            self.game.headless = True
+
+    def _get_image(self, pool=False, stacked=False):
+        self.game.fillImage(self._image)
+        if pool:
+            np.maximum(self._image, self._pool_image, out=self._image)
+        # frames that go into the stack are copied there anyway
+        if self.zero_copy or stacked:
+            return self._image_view
+        return self._image.copy()
 
-    def _get_obs(self):
+    def _get_obs(self, stacked=False):
         if self._obs_type == 'image':
-            return self._get_image()
+            return self._get_image(stacked=stacked)
         elif self._obs_type == 'objects':
-            return self.game.getObservation()
+            if self.max_objects is None:
+                return self.game.getObservation()
+            self.game.fillObservation(self._objects, self._mask)
+            if self.zero_copy:
+                return self._objects_view
+            return {'objects': self._objects.copy(), 'mask': self._mask.copy()}
         elif self._obs_type == 'features':
             return self.game.getFeatures()
+        elif self._obs_type == 'grid':
+            if self.zero_copy or stacked:
+                return self._grid_view
+            return self.game.grid.copy()
 
+    def _stack(self, obs):
+        if self.frame_stack == 1:
+            return obs
+        self._frames.push(obs)
+        if self.zero_copy:
+            return self._frames.view()
+        return self._frames.copy()
 
     def step(self, a):
-        self.game.tick(self._action_keys[a], True)
-        state = self._get_obs()
+        # an action index, or a direction to move the avatar in
+        if isinstance(a, tuple):
+            key = a
+        else:
+            key = self._action_keys[a]
+        # Pixels are only needed for image observations, and only of
+        # the last tick (and the one before that, when max-pooling)
+        image = self._obs_type == 'image'
+        stale = False
+        pooled = False
+        for i in range(self.frame_skip):
+            render = image and not stale and i == self.frame_skip - 1
+            self.game.tick(key, render)
+            stale = stale or (image and not render)
+            if self.game.ended:
+                break
+            if self.max_pool and i == self.frame_skip - 2:
+                self._draw_screen()
+                stale = False
+                self.game.fillImage(self._pool_image)
+                pooled = True
+        # a tick that ends the game returns before drawing, which leaves
+        # the screen out of date right after a restore_state
+        if stale or (image and self.game._drawn_screen is not self.screen):
+            self._draw_screen()
+        stacked = self.frame_stack > 1
+        if image:
+            state = self._get_image(pooled, stacked)
+        else:
+            state = self._get_obs(stacked)
+        state = self._stack(state)
         reward = self.game.score - self.score_last
         self.score_last = self.game.score
         terminal = self.game.ended
+        if self.recorder is not None:
+            assert not isinstance(a, tuple), "recording needs action indices"
+            self.recorder.step(a, reward, terminal)
+            self.recorder.observe(state)
         return state, reward, terminal, {}
 
+    def seed(self, seed=None):
+        """ Seed the game's random generator at the next reset. """
+        self._next_seed = seed
+        return [seed]
+
     def reset(self):
-        self.game.reset()
+        self.game.reset(self._next_seed)
+        self._next_seed = None
         self.game.buildLevel(self.level_desc)
         self.score_last = self.game.score
-        state = self._get_obs()
+        if self._obs_type == 'image':
+            self._draw_screen()
+        if self.frame_stack > 1:
+            self._frames.clear()
+        state = self._stack(self._get_obs(self.frame_stack > 1))
+        if self.recorder is not None:
+            self.recorder.observe(state, reset=True)
         return state
 
+    def replay(self, actions, seed=None, ticks=None, frames=False):
+        """ Play an episode of actions (indices or directions) again from the start,
+        on a game of its own, see BasicGame.replay. For the same episode, pass the
+        seed that was given to seed() before its reset. ticks count steps, each
+        frame_skip ticks of the game, and frames are max-pooled as with max_pool
+        (but not stacked). """
+        game = core.VGDLParser().parseGame(self.game_desc, **self.game_args)
+        keys = [a if isinstance(a, tuple) else self._action_keys[a] for a in actions]
+        return game.replay(self.level_desc, keys, seed, ticks, frames,
+                           self.frame_skip, self.max_pool)
+
+    def start_recording(self, directory, chunk_size=10000, flush_every=1000):
+        """ Stream all transitions from the next reset on into directory,
+        see TrajectoryRecorder. Steps of an episode under way are not recorded. """
+        assert self._obs_type != 'objects' or self.max_objects is not None, \
+            "recording objects observations needs max_objects"
+        self.stop_recording()
+        self.recorder = TrajectoryRecorder(directory, _obs_spec(self), chunk_size, flush_every)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def clone_state(self):
+        """ A snapshot of the game (and the frame stack) to go back to with restore_state. """
+        state = {'game': self.game.get_state(), 'score_last': self.score_last}
+        if self.frame_stack > 1:
+            state['frames'] = (self._frames._buf.copy(), self._frames._pos)
+        return state
+
+    def restore_state(self, state):
+        self.game.set_state(state['game'])
+        self.score_last = state['score_last']
+        if self.frame_stack > 1:
+            buf, self._frames._pos = state['frames']
+            self._frames._buf[...] = buf
+
     def render(self, mode='human', close=False):
         if close:
-            pygame.display.quit()
+            self._close_display()
+            return
+        if self._obs_type != 'image' or self.game._drawn_screen is not self.screen:
+            self._draw_screen()
         if mode == 'rgb_array':
             img = self._get_image()
             return img
@@ -140,7 +366,8 @@ class VGDLEnv(gym.Env):
             return True
 
     def close(self):
-        pygame.display.quit()
+        self.stop_recording()
+        self._close_display()
 
 
 
@@ -0,0 +1,245 @@
+from collections import OrderedDict
+import multiprocessing
+import numpy as np
+from .vgdl_env import VGDLEnv, _obs_spec
+from .vgdl import core
+
+
+def _copy_obs(buffers, index=Ellipsis):
+    """ Copy of (one entry of) the batched observation buffers,
+    in the same form as the observations of a single env. """
+    if None in buffers:
+        return buffers[None][index].copy()
+    return {key: buf[index].copy() for key, buf in buffers.items()}
+
+
+def _add_terminal_obs(infos, dones, terminal_buffers):
+    """ Pass the last observations of the games that ended along in their infos. """
+    for i in np.flatnonzero(dones):
+        infos[i]['terminal_observation'] = _copy_obs(terminal_buffers, i)
+    return infos
+
+
+class VGDLVecEnv(object):
+    """ Runs several VGDLEnv instances of the same game in lockstep, in-process.
+
+    Observations of all games are written into preallocated arrays of shape
+    (num_envs,) + observation shape. 'objects' observations are fixed tables of
+    max_objects rows, batched as a dict of 'objects' and 'mask' arrays. A game
+    that ends is reset right away; its last observation is kept in a second
+    batch of the same arrays and passed along as info['terminal_observation'].
+    Game i is seeded with seed + i (see seed), so stochastic games do not all
+    play out the same.
+    """
+
+    def __init__(self, num_envs, max_objects=200, obs_buffers=None, terminal_buffers=None,
+                 **env_kwargs):
+        self.num_envs = num_envs
+        self.max_objects = max_objects
+        # Observations are copied into the batch anyway, no need for
+        # the envs to hand out copies of their own
+        env_kwargs = dict(env_kwargs, zero_copy=True, max_objects=max_objects)
+        self.envs = [VGDLEnv(**env_kwargs) for _ in range(num_envs)]
+
+        env = self.envs[0]
+        self.action_space = env.action_space
+        self.observation_space = env.observation_space
+
+        # obs_buffers and terminal_buffers let the caller choose where
+        # observations live (e.g. shared memory)
+        spec = _obs_spec(env).items()
+        if obs_buffers is None:
+            obs_buffers = OrderedDict((key, np.zeros((num_envs,) + shape, dtype=dtype))
+                                      for key, (shape, dtype) in spec)
+        if terminal_buffers is None:
+            terminal_buffers = OrderedDict((key, np.zeros((num_envs,) + shape, dtype=dtype))
+                                           for key, (shape, dtype) in spec)
+        self._obs = obs_buffers
+        self._terminal = terminal_buffers
+        self._rewards = np.zeros(num_envs, dtype=np.float32)
+        self._dones = np.zeros(num_envs, dtype=bool)
+        self.seed()
+
+    def seed(self, seed=None):
+        """ Seed game i with seed + i at its next reset (by default
+        counting up from the game's own seed). """
+        if seed is None:
+            seed = core.BasicGame.seed
+        return [env.seed(int(seed) + i)[0] for i, env in enumerate(self.envs)]
+
+    @staticmethod
+    def _write_obs(buffers, i, obs):
+        if None in buffers:
+            buffers[None][i] = obs
+        else:
+            for key, buf in buffers.items():
+                buf[i] = obs[key]
+
+    def _reset_all(self):
+        for i, env in enumerate(self.envs):
+            self._write_obs(self._obs, i, env.reset())
+
+    def _step_all(self, actions):
+        infos = []
+        for i, (env, a) in enumerate(zip(self.envs, actions)):
+            obs, reward, done, info = env.step(a)
+            if done:
+                self._write_obs(self._terminal, i, obs)
+                obs = env.reset()
+            self._write_obs(self._obs, i, obs)
+            self._rewards[i] = reward
+            self._dones[i] = done
+            infos.append(info)
+        return infos
+
+    def reset(self):
+        self._reset_all()
+        return _copy_obs(self._obs)
+
+    def step(self, actions):
+        infos = _add_terminal_obs(self._step_all(actions), self._dones, self._terminal)
+        return _copy_obs(self._obs), self._rewards.copy(), self._dones.copy(), infos
+
+    def get_action_meanings(self):
+        return self.envs[0].get_action_meanings()
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+def _shared_views(shared):
+    return OrderedDict((key, np.frombuffer(array, dtype=dtype).reshape(shape))
+                       for key, (array, shape, dtype) in shared.items())
+
+
+def _subproc_worker(remote, parent_remote, shared, shared_terminal, start, stop,
+                    max_objects, env_kwargs):
+    """ Owns the games [start, stop) and writes their observations into shared,
+    and the last ones of the games that ended into shared_terminal. """
+    parent_remote.close()
+    obs, terminal = [OrderedDict((key, buf[start:stop])
+                                 for key, buf in _shared_views(s).items())
+                     for s in (shared, shared_terminal)]
+    venv = VGDLVecEnv(stop - start, max_objects=max_objects, obs_buffers=obs,
+                      terminal_buffers=terminal, **env_kwargs)
+    # number the games across all workers
+    venv.seed(core.BasicGame.seed + start)
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                infos = venv._step_all(data)
+                remote.send((venv._rewards, venv._dones, infos))
+            elif cmd == 'reset':
+                venv._reset_all()
+                remote.send(None)
+            elif cmd == 'seed':
+                remote.send(venv.seed(data + start))
+            elif cmd == 'close':
+                break
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        venv.close()
+        remote.close()
+
+
+class SubprocVGDLVecEnv(object):
+    """ Like VGDLVecEnv, but spreads the games over num_workers processes.
+
+    Every worker steps its own slice of games and writes their observations,
+    and the terminal ones, straight into shared-memory arrays, so only actions,
+    rewards, done flags and infos travel through the pipes.
+    """
+
+    def __init__(self, num_envs, num_workers=None, max_objects=200, start_method=None,
+                 **env_kwargs):
+        self.num_envs = num_envs
+        self.max_objects = max_objects
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        num_workers = max(1, min(num_workers, num_envs))
+
+        # Build one game locally, only to learn about the spaces
+        probe = VGDLEnv(max_objects=max_objects, **env_kwargs)
+        self.action_space = probe.action_space
+        self.observation_space = probe.observation_space
+        self._action_meanings = probe.get_action_meanings()
+        spec = _obs_spec(probe)
+        probe.close()
+
+        ctx = multiprocessing.get_context(start_method)
+        self._shared, self._shared_terminal = OrderedDict(), OrderedDict()
+        for key, (shape, dtype) in spec.items():
+            shape = (num_envs,) + shape
+            for shared in (self._shared, self._shared_terminal):
+                array = ctx.RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                shared[key] = (array, shape, dtype)
+        self._obs = _shared_views(self._shared)
+        self._terminal = _shared_views(self._shared_terminal)
+
+        bounds = np.linspace(0, num_envs, num_workers + 1).astype(int)
+        self._slices = list(zip(bounds[:-1], bounds[1:]))
+        self.remotes, self.processes = [], []
+        for start, stop in self._slices:
+            remote, work_remote = ctx.Pipe()
+            p = ctx.Process(target=_subproc_worker,
+                            args=(work_remote, remote, self._shared, self._shared_terminal,
+                                  start, stop, max_objects, env_kwargs))
+            p.daemon = True
+            p.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(p)
+        self.closed = False
+        self.waiting = False
+
+    def seed(self, seed=None):
+        """ See VGDLVecEnv.seed. """
+        if seed is None:
+            seed = core.BasicGame.seed
+        for remote in self.remotes:
+            remote.send(('seed', seed))
+        return [s for remote in self.remotes for s in remote.recv()]
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for remote in self.remotes:
+            remote.recv()
+        return _copy_obs(self._obs)
+
+    def step_async(self, actions):
+        actions = np.asarray(actions)
+        for remote, (start, stop) in zip(self.remotes, self._slices):
+            remote.send(('step', actions[start:stop]))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        rewards = np.concatenate([r for r, _, _ in results])
+        dones = np.concatenate([d for _, d, _ in results])
+        infos = [info for _, _, infos in results for info in infos]
+        _add_terminal_obs(infos, dones, self._terminal)
+        return _copy_obs(self._obs), rewards, dones, infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def get_action_meanings(self):
+        return self._action_meanings
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.processes:
+            p.join()
+        self.closed = True